@@ -1,98 +1,421 @@
+import codecs
+import errno
+import html
+import mmap
+import multiprocessing
 import os
+import queue
 import re
 import sys
+import threading
 import tkinter as tk
+from concurrent.futures import ProcessPoolExecutor
+from operator import itemgetter
 from tkinter import filedialog, messagebox, ttk
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
+from bs4.dammit import EncodingDetector
 from datetime import datetime
 
+# Prefer lxml directly, with one parser per charset reused for every file;
+# bs4 with the pure-Python html.parser is the fallback when lxml is missing.
+# Each parser is told the charset the page declares, so lxml reads the raw
+# bytes the same way as the other backends instead of guessing.
+try:
+    import lxml.etree
+    import lxml.html
+    H1_XPATH = lxml.etree.XPath(
+        "//h1[contains(concat(' ', normalize-space(@class), ' '), ' panel__title ')]"
+    )
+except ImportError:
+    lxml = None
+LXML_PARSERS = {}  # charset -> parser, or None if libxml2 cannot read it
+
+# Only <h1> elements are needed, so skip building the rest of the tree.
+# The class is matched afterwards with find(): filtering on class_ here
+# would miss headings that carry more than one class.
+H1_STRAINER = SoupStrainer('h1')
+
+# selectolax's lexbor backend is much faster than bs4 for a single lookup;
+# bs4 remains the fallback when it is not installed
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
+
+# Fast path: most pages have a plain <h1 class="panel__title"> that a regex
+# over the raw bytes can find without building any tree. Tag and attribute
+# names are case-insensitive in HTML, class values are not.
+H1_RE = re.compile(
+    rb'(?i:<h1)\b[^>]*\s(?i:class)\s*=\s*["\'][^"\']*(?<![^\s"\'])panel__title(?![^\s"\'])[^"\']*["\'][^>]*>(.*?)(?i:</h1)\s*>',
+    re.DOTALL,
+)
+TAG_RE = re.compile(rb'<[^>]+>')
+# Pages that never mention the class can be ruled out without any parsing
+TITLE_CLASS = b'panel__title'
+
+# One token as an HTML tokenizer splits the markup: a comment, another <!...>,
+# <?...> or </...> construct, a tag with its quoted attribute values, or text.
+# Unterminated constructs run to the end of the data, as they do in a browser.
+TOKEN_RE = re.compile(
+    rb'<!---?>|<!--.*?(?:--!?>|\Z)'
+    rb'|</?([A-Za-z][^\s/>]*)(?:[^>"\']|"[^"]*(?:"|\Z)|\'[^\']*(?:\'|\Z))*(?:>|\Z)'
+    rb'|<[!?/][^>]*(?:>|\Z)'
+    rb'|[^<]+|<',
+    re.DOTALL,
+)
+# Elements whose content the parsers do not read as ordinary markup
+RAW_TEXT_CLOSE_RES = {
+    name: re.compile(rb'</' + name + rb'[\s/>]', re.IGNORECASE)
+    for name in (b'script', b'style', b'textarea', b'title', b'xmp', b'iframe',
+                 b'noembed', b'noframes', b'noscript', b'template')
+}
+HEADING_NAMES = {b'h1', b'h2', b'h3', b'h4', b'h5', b'h6'}
+
+# Suffix for the intermediate names used while renaming in two phases
+TEMP_SUFFIX = '.__tmp_rename__'
+
+# The title sits near the top of the page, so only this prefix is read first
+HEAD_SIZE = 64 * 1024
+
+# Returned instead of a name when the page can only be read by a real parser
+NEEDS_PARSER = object()
+# Starting the worker processes takes about 0.2s, while a parser pass costs
+# about 1ms per 50KB page with lexbor or lxml, so the pool only pays off for
+# this many pages that need a parser
+PARALLEL_MIN_FILES = 1000
+
+INVALID_CHARS_RE = re.compile(r'[\\/:*?"<>|]')
+WHITESPACE_RE = re.compile(r'\s+')
+
 def sanitize_filename(filename):
     """
     Sanitize the filename by removing or replacing invalid characters.
     """
     # Remove invalid characters
-    sanitized = re.sub(r'[\\/:*?"<>|]', '', filename)
+    sanitized = INVALID_CHARS_RE.sub('', filename)
     # Replace spaces with underscores
-    sanitized = re.sub(r'\s+', '_', sanitized)
+    sanitized = WHITESPACE_RE.sub('_', sanitized)
     return sanitized
 
-def get_new_filename(html_file_path):
+def declared_encoding(data):
+    """
+    Return the charset declared in the page, or UTF-8 if it declares none (or an unknown one).
+    """
+    encoding = EncodingDetector.find_declared_encoding(data, is_html=True)
+    try:
+        return codecs.lookup(encoding).name if encoding else 'utf-8'
+    except LookupError:
+        return 'utf-8'
+
+def lxml_parser(encoding):
+    """
+    Return the shared lxml parser for the given charset, or None if libxml2 does not support it.
+    """
+    if encoding not in LXML_PARSERS:
+        try:
+            LXML_PARSERS[encoding] = lxml.html.HTMLParser(encoding=encoding)
+        except LookupError:
+            LXML_PARSERS[encoding] = None
+    return LXML_PARSERS[encoding]
+
+def tokens_align(data, pos, end, in_heading=False):
+    """
+    Return True if tokenizing data[pos:end] ends exactly at end, i.e. a parser
+    would read the markup at end as a new token rather than as part of a
+    comment, attribute value or raw-text element. Inside the heading, any
+    comment, raw-text element or other heading tag also returns False.
+    """
+    while pos < end:
+        token = TOKEN_RE.match(data, pos)
+        if token.end() > end:
+            return False
+        markup = token.group(0)
+        name = (token.group(1) or b'').lower()
+        is_end_tag = markup[1:2] == b'/'
+        if name == b'plaintext':
+            return False  # Everything after <plaintext> is text
+        if in_heading and (
+                (name == b'' and markup[:1] == b'<' and len(markup) > 1)
+                or name in RAW_TEXT_CLOSE_RES or name in HEADING_NAMES):
+            return False
+        pos = token.end()
+        if name in RAW_TEXT_CLOSE_RES and not is_end_tag:
+            # Skip the element's content up to its end tag
+            close = RAW_TEXT_CLOSE_RES[name].search(data, pos)
+            if not close:
+                return False
+            pos = close.start()
+    return pos == end
+
+def scan_title(data):
+    """
+    Return the text of the <h1 class="panel__title"> element matched by H1_RE,
+    or None if the page has to be left to a real HTML parser.
+    """
+    match = H1_RE.search(data)
+    if not match:
+        return None
+    # Only trust the match if the parsers would see the same heading: no
+    # earlier (e.g. unquoted) use of the class, the tag starts a real token,
+    # and the content holds nothing the regex cannot read through
+    if (data.find(TITLE_CLASS, 0, match.start()) != -1
+            or not tokens_align(data, 0, match.start())
+            or not tokens_align(data, match.start(), match.start(1))
+            or not tokens_align(data, match.start(1), match.end(1), in_heading=True)):
+        return None
+    try:
+        text = TAG_RE.sub(b'', match.group(1)).decode(declared_encoding(data[:HEAD_SIZE]))
+    except UnicodeDecodeError:
+        return None  # Let the parser path report the undecodable title
+    return html.unescape(text)
+
+def extract_title(html_file_path, parse=True):
+    """
+    Return the raw text of the <h1 class="panel__title"> element, or None if missing.
+    If parse is False, return NEEDS_PARSER where only an HTML parser could tell.
+    """
+    with open(html_file_path, 'rb') as file:
+        data = file.read(HEAD_SIZE)
+        found = TITLE_CLASS in data
+        if not found and len(data) < HEAD_SIZE:
+            return None
+        title = scan_title(data) if found else None
+        if title is None and len(data) == HEAD_SIZE:
+            # The title may lie past the prefix: scan the whole file through a
+            # read-only mapping, and copy it out only if a parser is needed
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                if mapped.find(TITLE_CLASS) == -1:
+                    return None
+                title = scan_title(mapped)
+                if title is None and parse:
+                    data = mapped[:]
+
+    # Only fall back to a real HTML parser when the regex misses
+    if title is not None:
+        return title
+    if not parse:
+        return NEEDS_PARSER
+
+    # Every backend reads the page in the charset it declares, so the title
+    # does not depend on which parser is installed. Bytes that do not fit
+    # come out as U+FFFD, which get_new_filename() rejects.
+    encoding = declared_encoding(data[:HEAD_SIZE])
+
+    if LexborHTMLParser is not None:
+        # lexbor reads bytes as UTF-8, so only other charsets are decoded here
+        source = data if encoding == 'utf-8' else data.decode(encoding, 'replace')
+        node = LexborHTMLParser(source).css_first('h1.panel__title')
+        return node.text() if node else None
+
+    if lxml is not None:
+        parser = lxml_parser(encoding)
+        if parser is None:
+            # A charset libxml2 does not know: hand it UTF-8 instead
+            data = data.decode(encoding, 'replace').encode('utf-8')
+            parser = lxml_parser('utf-8')
+        try:
+            tree = lxml.html.document_fromstring(data, parser=parser)
+        except lxml.etree.ParserError:
+            return None  # Empty document
+        h1s = H1_XPATH(tree)
+        return h1s[0].text_content() if h1s else None
+
+    soup = BeautifulSoup(data.decode(encoding, 'replace'), 'html.parser', parse_only=H1_STRAINER)
+    h1 = soup.find('h1', class_='panel__title')
+    return h1.text if h1 else None
+
+def get_new_filename(html_file_path, parse=True):
     """
     Extract the text from the <h1 class="panel__title"> element.
+    If parse is False, return NEEDS_PARSER where only an HTML parser could tell.
     """
     try:
-        with open(html_file_path, 'r', encoding='utf-8') as file:
-            soup = BeautifulSoup(file, 'html.parser')
-            h1 = soup.find('h1', class_='panel__title')
-            if h1 and h1.text.strip():
-                return sanitize_filename(h1.text.strip()) + '.html'
-            else:
-                print(f"Warning: <h1 class='panel__title'> not found or empty in {html_file_path}. Skipping.")
-                return None
+        title = extract_title(html_file_path, parse)
+        if title is NEEDS_PARSER:
+            return title
+        if title and '\ufffd' in title:
+            # Bytes that do not fit the page's charset, as in a strict decode
+            print(f"Error processing {html_file_path}: the title does not decode in the page's charset. Skipping.")
+            return None
+        if title and title.strip():
+            return sanitize_filename(title.strip()) + '.html'
+        else:
+            print(f"Warning: <h1 class='panel__title'> not found or empty in {html_file_path}. Skipping.")
+            return None
     except Exception as e:
         print(f"Error processing {html_file_path}: {e}")
         return None
 
+def rename_no_replace(src, dst):
+    """
+    Rename src to dst, raising FileExistsError rather than replacing an existing dst.
+    """
+    if os.name == 'nt':
+        os.rename(src, dst)  # Never replaces on Windows
+        return
+    try:
+        # link() fails atomically if dst exists, unlike rename() on POSIX
+        os.link(src, dst)
+    except FileExistsError:
+        raise
+    except OSError:
+        # No hard links on this filesystem: check right before renaming
+        if os.path.lexists(dst):
+            raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), dst)
+        os.rename(src, dst)
+        return
+    try:
+        os.unlink(src)
+    except OSError:
+        os.unlink(dst)
+        raise
+
 def rename_html_files(directory, add_index=False):
     """
     Rename all .html files in the given directory based on their <h1 class="panel__title"> content.
     If add_index is True, prefix filenames with an index based on creation date.
+    Returns (renamed_files, skipped_files, stranded_files); stranded_files lists
+    (original, temporary) names of files that could not be put back after an error.
     """
     # Retrieve all .html files with their creation times
+    # scandir entries reuse the stat data from the directory listing where the OS provides it
+    # Every name in the directory is kept for conflict checks. Names are
+    # casefolded because the filesystem may be case-insensitive (Windows,
+    # macOS, FAT/NTFS/SMB mounts on Linux) whatever the platform says
     html_files = []
-    for filename in os.listdir(directory):
-        if filename.lower().endswith('.html'):
-            filepath = os.path.join(directory, filename)
-            try:
-                creation_time = os.path.getctime(filepath)
-                html_files.append((filename, creation_time))
-            except Exception as e:
-                print(f"Error accessing {filepath}: {e}")
+    existing_names = set()
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            existing_names.add(entry.name.casefold())
+            if entry.name.lower().endswith('.html'):
+                try:
+                    if entry.is_file():
+                        html_files.append((entry.name, entry.stat().st_ctime))
+                except Exception as e:
+                    print(f"Error accessing {entry.path}: {e}")
 
     # Sort files by creation time (oldest first)
-    html_files.sort(key=lambda x: x[1])
+    html_files.sort(key=itemgetter(1))
 
-    new_filenames = {}
+    suffix_counts = {}  # next duplicate suffix to try for each title
+    assigned_names = set()
     renamed_files = []
     skipped_files = []
+    stranded_files = []
     index = 1  # Initialize index for prefixing
 
-    for original_filename, _ in html_files:
-        original_filepath = os.path.join(directory, original_filename)
-        new_name = get_new_filename(original_filepath)
+    # Most titles come from the regex fast path, which is cheaper than
+    # starting a worker. Only the pages that need an HTML parser are spread
+    # across processes, and only when there are enough of them; the renaming
+    # below stays serial to resolve duplicates
+    filepaths = [os.path.join(directory, filename) for filename, _ in html_files]
+    new_names = [get_new_filename(filepath, parse=False) for filepath in filepaths]
+    pending = [i for i, new_name in enumerate(new_names) if new_name is NEEDS_PARSER]
+    pending_paths = [filepaths[i] for i in pending]
+    workers = os.cpu_count() or 1
+    if workers > 1 and len(pending) >= PARALLEL_MIN_FILES:
+        # The GUI calls this from a worker thread, and forking a multithreaded
+        # process can deadlock, so always start clean interpreters
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            chunksize = max(1, len(pending) // (workers * 4))
+            parsed = list(executor.map(get_new_filename, pending_paths, chunksize=chunksize))
+    else:
+        parsed = [get_new_filename(filepath) for filepath in pending_paths]
+    for i, new_name in zip(pending, parsed):
+        new_names[i] = new_name
+
+    # Work out every target name before touching the filesystem
+    planned = []
+    for (original_filename, _), new_name in zip(html_files, new_names):
         if new_name:
-            # Handle duplicate filenames
+            # Handle duplicate filenames, starting from the next free suffix;
+            # names are compared casefolded, like existing_names
             base_name, ext = os.path.splitext(new_name)
-            duplicate_count = new_filenames.get(new_name, 0)
-            if duplicate_count > 0:
-                new_name = f"{base_name}_{duplicate_count}{ext}"
-            new_filenames[new_name] = duplicate_count + 1
+            suffix = suffix_counts.get(new_name.casefold(), 0)
+            candidate = f"{base_name}_{suffix}{ext}" if suffix else new_name
+            while candidate.casefold() in assigned_names:
+                suffix += 1
+                candidate = f"{base_name}_{suffix}{ext}"
+            suffix_counts[new_name.casefold()] = suffix + 1
+            assigned_names.add(candidate.casefold())
+            new_name = candidate
 
             # If add_index is enabled, prefix the filename with the index
             if add_index:
                 new_name = f"{index}. {new_name}"
                 index += 1
 
-            # Ensure the new filename does not already exist
-            target_filepath = os.path.join(directory, new_name)
-            if os.path.exists(target_filepath):
-                print(f"Error: Cannot rename {original_filename} to {new_name} because {new_name} already exists. Skipping.")
-                skipped_files.append((original_filename, new_name))
-                continue
-
-            try:
-                os.rename(original_filepath, target_filepath)
-                print(f"Renamed '{original_filename}' to '{new_name}'")
-                renamed_files.append((original_filename, new_name))
-            except Exception as e:
-                print(f"Error renaming {original_filename} to {new_name}: {e}")
-                skipped_files.append((original_filename, new_name))
+            planned.append((original_filename, new_name))
         else:
             skipped_files.append((original_filename, None))
 
-    return renamed_files, skipped_files
+    # A target is only taken if a file that stays in place holds it. Files
+    # that move free their names, so drop blocked renames until none remain.
+    # A change of case only still moves the file.
+    moving = [(original, new) for original, new in planned if new != original]
+    while True:
+        occupied = existing_names - {original.casefold() for original, _ in moving}
+        allowed = [(original, new) for original, new in moving if new.casefold() not in occupied]
+        if len(allowed) == len(moving):
+            break
+        moving = allowed
+
+    moving_set = set(moving)
+    for original_filename, new_name in planned:
+        if (original_filename, new_name) not in moving_set:
+            print(f"Error: Cannot rename {original_filename} to {new_name} because {new_name} already exists. Skipping.")
+            skipped_files.append((original_filename, new_name))
+
+    # Phase 1: move each source out of the way under a temporary name
+    staged = []
+    for original_filename, new_name in moving:
+        # Never reuse a name already in the directory, e.g. one left by an earlier run
+        temp_filename = original_filename + TEMP_SUFFIX
+        attempt = 1
+        while temp_filename.casefold() in existing_names:
+            temp_filename = f"{original_filename}{TEMP_SUFFIX}{attempt}"
+            attempt += 1
+        try:
+            rename_no_replace(os.path.join(directory, original_filename), os.path.join(directory, temp_filename))
+            existing_names.discard(original_filename.casefold())
+            existing_names.add(temp_filename.casefold())
+            staged.append((original_filename, temp_filename, new_name))
+        except Exception as e:
+            print(f"Error renaming {original_filename} to {new_name}: {e}")
+            skipped_files.append((original_filename, new_name))
 
-def select_directory_and_rename(add_index=False):
+    # Phase 2: give every staged file its final name
+    for original_filename, temp_filename, new_name in staged:
+        temp_filepath = os.path.join(directory, temp_filename)
+        try:
+            # A failed phase 1 rename can leave the target taken here
+            if new_name.casefold() in existing_names:
+                raise FileExistsError(f"{new_name} already exists")
+            rename_no_replace(temp_filepath, os.path.join(directory, new_name))
+            existing_names.discard(temp_filename.casefold())
+            existing_names.add(new_name.casefold())
+            print(f"Renamed '{original_filename}' to '{new_name}'")
+            renamed_files.append((original_filename, new_name))
+            continue
+        except Exception as e:
+            print(f"Error renaming {original_filename} to {new_name}: {e}")
+            skipped_files.append((original_filename, new_name))
+
+        # Put the file back under its original name if that is still free
+        try:
+            if original_filename.casefold() in existing_names:
+                raise FileExistsError(f"{original_filename} is now taken")
+            rename_no_replace(temp_filepath, os.path.join(directory, original_filename))
+            existing_names.discard(temp_filename.casefold())
+            existing_names.add(original_filename.casefold())
+        except Exception as e:
+            print(f"Error: {original_filename} was left as {temp_filename}: {e}")
+            stranded_files.append((original_filename, temp_filename))
+
+    return renamed_files, skipped_files, stranded_files
+
+def select_directory_and_rename(root, button, add_index=False):
     """
     Open a GUI dialog to select a directory and perform the renaming operation.
     """
@@ -108,10 +431,37 @@ def select_directory_and_rename(add_index=False):
     if not confirm:
         return
 
-    # Perform renaming
-    renamed_files, skipped_files = rename_html_files(directory, add_index=add_index)
+    # Perform renaming on a worker thread so the window stays responsive;
+    # the outcome is handed back through a queue polled from the event loop
+    results = queue.Queue()
+
+    def run():
+        try:
+            results.put(rename_html_files(directory, add_index=add_index))
+        except Exception as e:
+            results.put(e)
+
+    button.config(state=tk.DISABLED)
+    threading.Thread(target=run).start()
+    poll_rename_results(root, button, results)
+
+def poll_rename_results(root, button, results):
+    """
+    Show the result once the renaming thread has finished, otherwise check again shortly.
+    """
+    try:
+        result = results.get_nowait()
+    except queue.Empty:
+        root.after(50, poll_rename_results, root, button, results)
+        return
+
+    button.config(state=tk.NORMAL)
+    if isinstance(result, Exception):
+        messagebox.showerror("Error", f"Renaming failed: {result}")
+        return
 
     # Prepare the result message
+    renamed_files, skipped_files, stranded_files = result
     message = f"Renaming Completed!\n\nTotal files renamed: {len(renamed_files)}\nTotal files skipped: {len(skipped_files)}"
     if skipped_files:
         message += "\n\nSkipped Files:\n"
@@ -121,6 +471,14 @@ def select_directory_and_rename(add_index=False):
             else:
                 message += f"- {original} (No <h1 class='panel__title'> found)\n"
 
+    if stranded_files:
+        # These files are no longer under their own name, so say where they went
+        message += "\n\nFiles left under a temporary name (rename them back by hand):\n"
+        for original, temp in stranded_files:
+            message += f"- {original} is now {temp}\n"
+        messagebox.showwarning("Result", message)
+        return
+
     messagebox.showinfo("Result", message)
 
 def create_gui():
@@ -150,7 +508,7 @@ def create_gui():
     add_index_check.pack(pady=10)
 
     # Add a button to select directory
-    select_button = tk.Button(root, text="Select Directory and Rename", command=lambda: select_directory_and_rename(add_index=add_index_var.get()), width=25, height=2)
+    select_button = tk.Button(root, text="Select Directory and Rename", command=lambda: select_directory_and_rename(root, select_button, add_index=add_index_var.get()), width=25, height=2)
     select_button.pack(pady=10)
 
     # Add an exit button
@@ -160,4 +518,6 @@ def create_gui():
     root.mainloop()
 
 if __name__ == "__main__":
+    # Frozen Windows builds would otherwise start the GUI in every worker
+    multiprocessing.freeze_support()
     create_gui()
@@ -0,0 +1,255 @@
+import os
+
+import pytest
+
+import rename_html_files
+from rename_html_files import HEAD_SIZE, TEMP_SUFFIX, extract_title, scan_title
+
+
+# Pages where a naive regex would disagree with the HTML parsers
+TRICKY_PAGES = [
+    b'<h1 class="panel__title">A<!-- </h1> -->B</h1>',
+    b'<h1 class="x.panel__title">Wrong</h1><h1 class="panel__title">Right</h1>',
+    b'<h1 class=panel__title>First</h1><h1 class="panel__title">Second</h1>',
+    b'<!-- <h1 class="panel__title">Old</h1> --><h1 class="panel__title">Real</h1>',
+    b'<script>var t = "<h1 class=\\"panel__title\\">Tmpl</h1>";</script><h1 class="panel__title">Real</h1>',
+    b'<div title=\'<h1 class="panel__title">Attr</h1>\'></div><h1 class="panel__title">Real</h1>',
+    b'<textarea><h1 class="panel__title">Text</h1></textarea><h1 class="panel__title">Real</h1>',
+    b'<h1 class="panel__title">A<h2>B</h2></h1>',
+    b'<h1 class="panel__title" data-x="a>b">T</h1>',
+    b'<h1 class="panel__title">A <span title="</h1>">B</span></h1>',
+]
+
+# Pages the fast path is expected to handle on its own
+PLAIN_PAGES = [
+    b'<h1 class="panel__title">Plain</h1>',
+    b'<H1 CLASS="panel__title">Upper tag</H1>',
+    b'<title>t</title><script>1</script><h1 class="a panel__title b">Ok &amp; <b>bold</b></h1>',
+    b'<p>a < b</p><h1 class="panel__title">Less than</h1>',
+]
+
+
+def parsed_title(path, monkeypatch):
+    with monkeypatch.context() as patch:
+        patch.setattr(rename_html_files, 'scan_title', lambda data: None)
+        return extract_title(str(path))
+
+
+@pytest.mark.parametrize('page', TRICKY_PAGES + PLAIN_PAGES)
+def test_fast_path_agrees_with_parser(tmp_path, monkeypatch, page):
+    path = tmp_path / 'page.html'
+    path.write_bytes(page)
+
+    assert extract_title(str(path)) == parsed_title(path, monkeypatch)
+
+
+@pytest.mark.parametrize('page', PLAIN_PAGES)
+def test_fast_path_handles_plain_pages(page):
+    assert scan_title(page) is not None
+
+
+def test_fast_path_matches_class_case_sensitively():
+    assert scan_title(b'<h1 class="PANEL__TITLE">Upper</h1>') is None
+
+
+HEADING = b'<h1 class="panel__title">Deep</h1>'
+
+
+@pytest.mark.parametrize('page', [
+    b'x' * HEAD_SIZE + HEADING,  # Past the prefix
+    b'x' * (HEAD_SIZE - 10) + HEADING,  # Across the end of the prefix
+    b'x' * (HEAD_SIZE - len(HEADING)) + HEADING,  # Exactly HEAD_SIZE bytes
+])
+def test_title_is_found_beyond_the_prefix(tmp_path, monkeypatch, page):
+    path = tmp_path / 'page.html'
+    path.write_bytes(page)
+
+    assert extract_title(str(path)) == 'Deep'
+    assert parsed_title(path, monkeypatch) == 'Deep'
+
+
+def test_page_of_exactly_head_size_without_title(tmp_path):
+    path = tmp_path / 'page.html'
+    path.write_bytes(b'x' * HEAD_SIZE)
+
+    assert extract_title(str(path)) is None
+
+
+def test_parser_reads_whole_file_when_fast_path_misses(tmp_path):
+    path = tmp_path / 'page.html'
+    path.write_bytes(b'x' * HEAD_SIZE + TRICKY_PAGES[0])
+
+    assert scan_title(path.read_bytes()) is None
+    assert extract_title(str(path)) == 'AB'
+
+
+def test_parser_reads_declared_charset(tmp_path, monkeypatch):
+    path = tmp_path / 'page.html'
+    path.write_bytes('<meta charset="windows-1252"><h1 class="panel__title">Café</h1>'.encode('cp1252'))
+
+    assert extract_title(str(path)) == 'Café'
+    assert parsed_title(path, monkeypatch) == 'Café'
+
+
+def test_undecodable_title_is_skipped(tmp_path, monkeypatch):
+    path = tmp_path / 'page.html'
+    path.write_bytes(b'<h1 class="panel__title">Caf\xe9</h1>')
+    monkeypatch.setattr(rename_html_files, 'scan_title', lambda data: None)
+
+    assert rename_html_files.get_new_filename(str(path)) is None
+
+
+def write_page(directory, filename, title):
+    path = directory / filename
+    path.write_text(f'<html><body><h1 class="panel__title">{title}</h1></body></html>', encoding='utf-8')
+    return path
+
+
+def test_case_only_conflict_does_not_overwrite(tmp_path):
+    write_page(tmp_path, 'a.html', 'Foo')
+    (tmp_path / 'foo.html').write_text('keep')
+
+    renamed, skipped, stranded = rename_html_files.rename_html_files(str(tmp_path))
+
+    assert renamed == []
+    assert ('a.html', 'Foo.html') in skipped
+    assert (tmp_path / 'foo.html').read_text() == 'keep'
+
+
+def test_case_only_rename_is_allowed(tmp_path):
+    write_page(tmp_path, 'foo.html', 'Foo')
+
+    renamed, skipped, stranded = rename_html_files.rename_html_files(str(tmp_path))
+
+    assert renamed == [('foo.html', 'Foo.html')]
+    assert skipped == [] and stranded == []
+    assert '>Foo<' in (tmp_path / 'Foo.html').read_text()
+
+
+def test_file_created_after_scan_is_not_overwritten(tmp_path, monkeypatch):
+    write_page(tmp_path, 'a.html', 'Late')
+    real_get_new_filename = rename_html_files.get_new_filename
+
+    def create_target(path, parse=True):
+        (tmp_path / 'Late.html').write_text('keep')
+        return real_get_new_filename(path, parse)
+
+    monkeypatch.setattr(rename_html_files, 'get_new_filename', create_target)
+    renamed, skipped, stranded = rename_html_files.rename_html_files(str(tmp_path))
+
+    assert renamed == []
+    assert skipped == [('a.html', 'Late.html')]
+    assert stranded == []
+    assert (tmp_path / 'Late.html').read_text() == 'keep'
+    assert '>Late<' in (tmp_path / 'a.html').read_text()
+
+
+def test_repeated_titles_get_increasing_suffixes(tmp_path):
+    for i, title in enumerate(['A', 'A', 'A_1', 'A']):
+        write_page(tmp_path, f'f{i}.html', title)
+
+    renamed, skipped, stranded = rename_html_files.rename_html_files(str(tmp_path))
+
+    assert skipped == []
+    assert len({new for _, new in renamed}) == 4
+
+
+def test_titles_differing_in_case_get_distinct_names(tmp_path):
+    write_page(tmp_path, 'a.html', 'Foo')
+    write_page(tmp_path, 'b.html', 'foo')
+
+    renamed, skipped, stranded = rename_html_files.rename_html_files(str(tmp_path))
+
+    assert skipped == []
+    assert {new.casefold() for _, new in renamed} == {'foo.html', 'foo_1.html'}
+
+
+def test_swapped_names_are_renamed(tmp_path):
+    write_page(tmp_path, 'a.html', 'b')
+    write_page(tmp_path, 'b.html', 'a')
+
+    renamed, skipped, stranded = rename_html_files.rename_html_files(str(tmp_path))
+
+    assert sorted(renamed) == [('a.html', 'b.html'), ('b.html', 'a.html')]
+    assert skipped == [] and stranded == []
+    assert '>b<' in (tmp_path / 'b.html').read_text()
+    assert '>a<' in (tmp_path / 'a.html').read_text()
+    assert sorted(os.listdir(tmp_path)) == ['a.html', 'b.html']
+
+
+def test_leftover_temporary_file_is_kept(tmp_path):
+    write_page(tmp_path, 'a.html', 'New')
+    (tmp_path / ('a.html' + TEMP_SUFFIX)).write_text('PRECIOUS')
+
+    renamed, skipped, stranded = rename_html_files.rename_html_files(str(tmp_path))
+
+    assert renamed == [('a.html', 'New.html')]
+    assert (tmp_path / ('a.html' + TEMP_SUFFIX)).read_text() == 'PRECIOUS'
+    assert sorted(os.listdir(tmp_path)) == ['New.html', 'a.html' + TEMP_SUFFIX]
+
+
+def test_phase_two_failure_restores_original_name(tmp_path, monkeypatch):
+    write_page(tmp_path, 'a.html', 'Target')
+    real_rename = rename_html_files.rename_no_replace
+
+    def failing_rename(src, dst):
+        if dst.endswith('Target.html'):
+            raise PermissionError('denied')
+        real_rename(src, dst)
+
+    monkeypatch.setattr(rename_html_files, 'rename_no_replace', failing_rename)
+    renamed, skipped, stranded = rename_html_files.rename_html_files(str(tmp_path))
+
+    assert renamed == []
+    assert skipped == [('a.html', 'Target.html')]
+    assert stranded == []
+    assert os.listdir(tmp_path) == ['a.html']
+
+
+def test_file_that_cannot_be_restored_is_reported(tmp_path, monkeypatch):
+    write_page(tmp_path, 'a.html', 'Target')
+    real_rename = rename_html_files.rename_no_replace
+
+    def failing_rename(src, dst):
+        if TEMP_SUFFIX in src:
+            raise PermissionError('denied')
+        real_rename(src, dst)
+
+    monkeypatch.setattr(rename_html_files, 'rename_no_replace', failing_rename)
+    renamed, skipped, stranded = rename_html_files.rename_html_files(str(tmp_path))
+
+    assert renamed == []
+    assert skipped == [('a.html', 'Target.html')]
+    assert stranded == [('a.html', 'a.html' + TEMP_SUFFIX)]
+    assert os.listdir(tmp_path) == ['a.html' + TEMP_SUFFIX]
+
+
+def test_only_pages_that_need_a_parser_go_to_the_pool(tmp_path, monkeypatch):
+    write_page(tmp_path, 'plain.html', 'Plain')
+    (tmp_path / 'tricky.html').write_bytes(TRICKY_PAGES[0])
+    pooled = []
+
+    class RecordingExecutor:
+        """Stand-in for ProcessPoolExecutor that runs calls in this process."""
+
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            return False
+
+        def map(self, fn, iterable, chunksize=1):
+            paths = list(iterable)
+            pooled.extend(os.path.basename(path) for path in paths)
+            return map(fn, paths)
+
+    monkeypatch.setattr(rename_html_files, 'ProcessPoolExecutor', RecordingExecutor)
+    monkeypatch.setattr(rename_html_files, 'PARALLEL_MIN_FILES', 1)
+    monkeypatch.setattr(os, 'cpu_count', lambda: 2)
+    renamed, skipped, stranded = rename_html_files.rename_html_files(str(tmp_path))
+
+    assert pooled == ['tricky.html']
+    assert sorted(renamed) == [('plain.html', 'Plain.html'), ('tricky.html', 'AB.html')]